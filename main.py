@@ -9,11 +9,24 @@ import time
 import vevor
 import os
 import sys
-import subprocess
+import socket
+import fcntl
+import errno
 import gc
 import queue
+import threading
+import signal
+import bisect
+from dataclasses import dataclass
+from enum import IntEnum
 from bluepy.btle import BTLEDisconnectError
 
+
+def json_dumps(obj):
+    """Serialize to a bytes payload, ready for client.publish()"""
+    return json.dumps(obj).encode()
+
+
 # = Configuration
 # == BLE bridge
 ble_mac_address = os.environ["BLE_MAC_ADDRESS"]
@@ -42,23 +55,103 @@ mqtt_discovery_prefix = (
     else "homeassistant"
 )
 mqtt_prefix = f"{os.environ.get('MQTT_PREFIX', '').rstrip('/')}/{device_id}"
+# Also publish every sensor on its own topic (Home Assistant discovery then uses those instead of the JSON state)
+mqtt_legacy_topics = (os.environ.get("MQTT_LEGACY_TOPICS") or "false").lower() in ["true", "1", "yes"]
+# == MQTT topics
+topic_state = f"{mqtt_prefix}/state"  # all status fields as one retained JSON object
+topic_start_cmd = f"{mqtt_prefix}/start/cmd"
+topic_start_av = f"{mqtt_prefix}/start/av"
+topic_stop_cmd = f"{mqtt_prefix}/stop/cmd"
+topic_stop_av = f"{mqtt_prefix}/stop/av"
+topic_status_state = f"{mqtt_prefix}/status/state"
+topic_temp_limiting_state = f"{mqtt_prefix}/temp_limiting/state"
+topic_overheat_state = f"{mqtt_prefix}/overheat/state"
+topic_room_temperature_state = f"{mqtt_prefix}/room_temperature/state"
+topic_heater_temperature_state = f"{mqtt_prefix}/heater_temperature/state"
+topic_voltage_state = f"{mqtt_prefix}/voltage/state"
+topic_altitude_state = f"{mqtt_prefix}/altitude/state"
+topic_mode_cmd = f"{mqtt_prefix}/mode/cmd"
+topic_mode_av = f"{mqtt_prefix}/mode/av"
+topic_mode_state = f"{mqtt_prefix}/mode/state"
+topic_level_cmd = f"{mqtt_prefix}/level/cmd"
+topic_level_av = f"{mqtt_prefix}/level/av"
+topic_level_state = f"{mqtt_prefix}/level/state"
+topic_temperature_cmd = f"{mqtt_prefix}/temperature/cmd"
+topic_temperature_av = f"{mqtt_prefix}/temperature/av"
+topic_temperature_state = f"{mqtt_prefix}/temperature/state"
+# == Logging
+log_level = os.environ["LOG_LEVEL"].upper() if os.environ.get("LOG_LEVEL") else "DEBUG"
 
 client = None
 logger = None
-vdh = None
+vdh = None  # connected heater, None while BLE is down
+heater = None  # DieselHeater kept across disconnects, so reconnects skip GATT discovery
 run = True
 modes = ["Power Level", "Temperature"]
+# Raw mode/cmd payload -> heater mode number (1-based, as expected by set_mode)
+mode_numbers = {mode.encode("ascii"): i + 1 for i, mode in enumerate(modes)}
+
+
+class SysState(IntEnum):
+    """Bridge connection state, shown next to the heater status while not connected"""
+    CONNECTED = 0
+    RECONNECTING = 1
+    DISCONNECTED = 2
+    CONNECTION_FAILED = 3
+    TIMEOUT = 4
+    WATCHDOG_TRIGGERED = 5
+    ERROR = 6
+
+
+# Published names, indexed by SysState
+sys_state_names = ("Connected", "Reconnecting", "Disconnected", "Connection Failed", "Timeout", "Watchdog Triggered", "Error")
+sys_state_payloads = tuple(name.encode() for name in sys_state_names)
 
 # Command queue for thread-safe BLE access
 # MQTT on_message runs in a separate thread - bluepy is NOT thread-safe
 # All BLE commands must be executed from the main loop thread
 command_queue = queue.Queue()
+# Set when a command is queued so the main loop wakes up instead of sleeping out the poll interval
+poll_wake = threading.Event()
+# Set on SIGTERM/SIGINT - interrupts reconnect delays so the container stops promptly
+shutdown_requested = threading.Event()
+
+# Last payload sent per topic - unchanged values are not re-published
+last_published = {}
+# Home Assistant marks sensors with expire_after unavailable unless they are refreshed in time
+sensor_expire_after = 10  # seconds
+# Error-path status: an unchanged state is re-sent at this interval, well within expire_after
+status_refresh_interval = sensor_expire_after / 2
+status_sent_at = 0.0
+# Sensors with expire_after must keep refreshing, so they bypass this cache
+expiring_topics = frozenset((
+    topic_status_state,
+    topic_room_temperature_state,
+    topic_heater_temperature_state,
+    topic_voltage_state,
+    topic_altitude_state,
+) if mqtt_legacy_topics else (
+    topic_status_state,
+    topic_state,  # sensor entities read their values from here
+))
+# Broker connection losses since startup, for logging only
+mqtt_disconnects = 0
+availability_topics = (topic_start_av, topic_stop_av, topic_level_av, topic_temperature_av, topic_mode_av)
+# Controls while the heater is unreachable
+availability_offline = tuple((topic, b"offline", 0, True) for topic in availability_topics)
+# Status values meaning the heater is unreachable: the "Offline" will, the BLE error states and the ignored-command notice
+status_offline_values = ["Offline", *sys_state_names[SysState.RECONNECTING:], "Disconnected - command ignored"]
+# Availability entry derived from the status topic, for entities without their own availability topic
+status_availability = {
+    "topic": topic_status_state,
+    "value_template": f"{{{{ 'offline' if value in {status_offline_values} else 'online' }}}}",
+}
 
 def init_logger():
     logger = logging.getLogger("vevor-ble-bridge")
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(log_level)
     ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+    ch.setLevel(log_level)
     formatter = logging.Formatter(
         "%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S %z"
     )
@@ -69,232 +162,202 @@ def init_logger():
 
 def init_client():
     client = mqtt.Client(client_id=device_id, clean_session=True)
+    # Bound paho's QoS 1 message store during a broker outage - only the status uses QoS 1,
+    # so one in flight is enough; once 50 are waiting, further publishes fail instead of piling up
+    client.max_inflight_messages_set(1)
+    client.max_queued_messages_set(50)
     if mqtt_username and len(mqtt_username) and mqtt_password and len(mqtt_password):
-        logger.info(
-            f"Connecting to MQTT broker {mqtt_username}@{mqtt_host}:{mqtt_port}"
-        )
+        logger.info("Connecting to MQTT broker %s@%s:%s", mqtt_username, mqtt_host, mqtt_port)
         client.username_pw_set(mqtt_username, mqtt_password)
     else:
-        logger.info(f"Connecting to MQTT broker {mqtt_host}:{mqtt_port}")
+        logger.info("Connecting to MQTT broker %s:%s", mqtt_host, mqtt_port)
     # Set all callbacks before connecting
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
     client.on_publish = on_publish
+    # Broker reconnects are left to paho's network thread, with its own backoff
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    # If the bridge drops off, the broker itself replaces the retained status
+    client.will_set(topic_status_state, b"Offline", qos=1, retain=True)
     client.connect(mqtt_host, port=mqtt_port)
     return client
 
 
 def cleanup_ble_device(device):
-    """Properly cleanup BLE device object before reconnect"""
+    """
+    Properly cleanup BLE device object before reconnect.
+    No settle delay here: bluepy's disconnect() returns once the link is down,
+    and every caller already waits a reconnect backoff before connecting again.
+    """
     if device is not None:
         try:
             logger.info("Cleaning up BLE connection...")
             device.disconnect()
             logger.debug("BLE disconnect() called successfully")
         except Exception as e:
-            logger.warning(f"Error during BLE disconnect: {e}")
+            logger.warning("Error during BLE disconnect: %s", e)
 
-        try:
-            # Force garbage collection to cleanup bluepy objects
-            del device
-            gc.collect()
-            logger.debug("BLE object deleted and garbage collected")
-        except Exception as e:
-            logger.warning(f"Error during BLE cleanup: {e}")
 
-    # Minimal delay to let BLE stack settle - faster reconnect
-    time.sleep(0.2)
+# HCI device ioctls from <bluetooth/hci.h> - the same calls hciconfig makes, without forking it
+HCIDEVUP = 0x400448C9
+HCIDEVDOWN = 0x400448CA
+hci_device_id = 0  # hci0
 
 
 def reset_ble_adapter():
     """Reset BLE adapter to clear stuck state"""
     try:
         logger.warning("Resetting BLE adapter (hci0)...")
-        subprocess.run(["hciconfig", "hci0", "down"], check=False, capture_output=True, timeout=5)
-        time.sleep(1)
-        subprocess.run(["hciconfig", "hci0", "up"], check=False, capture_output=True, timeout=5)
+        af_bluetooth = getattr(socket, "AF_BLUETOOTH", 31)
+        btproto_hci = getattr(socket, "BTPROTO_HCI", 1)
+        with socket.socket(af_bluetooth, socket.SOCK_RAW, btproto_hci) as sock:
+            fcntl.ioctl(sock.fileno(), HCIDEVDOWN, hci_device_id)
+            time.sleep(0.2)
+            try:
+                fcntl.ioctl(sock.fileno(), HCIDEVUP, hci_device_id)
+            except OSError as e:
+                if e.errno != errno.EALREADY:  # already brought back up by bluetoothd
+                    raise
         time.sleep(2)
         logger.info("BLE adapter reset complete")
         return True
-    except subprocess.TimeoutExpired:
-        logger.error("BLE adapter reset timed out")
-        return False
     except Exception as e:
-        logger.error(f"Failed to reset BLE adapter: {e}")
+        logger.error("Failed to reset BLE adapter: %s", e)
         return False
 
 
-def get_device_conf():
-    conf = {
-        "name": device_name,
-        "identifiers": device_id,
-        "manufacturer": device_manufacturer,
-        "model": device_id,
-        "via_device": via_device,
-        "sw": "Vevor-BLE-Bridge",
+device_conf = {
+    "name": device_name,
+    "identifiers": device_id,
+    "manufacturer": device_manufacturer,
+    "model": device_id,
+    "via_device": via_device,
+    "sw": "Vevor-BLE-Bridge",
+}
+
+
+def sensor_state(topic, field):
+    """Discovery keys for a sensor value: its own topic, or a field of the JSON state"""
+    if mqtt_legacy_topics:
+        return {"state_topic": topic}
+    return {"state_topic": topic_state, "value_template": "{{ value_json.%s }}" % field}
+
+
+def control_availability(topic):
+    """
+    Discovery keys for a control's availability: its own topic, and the status topic,
+    which carries the "Offline" will when the bridge drops off the broker without a clean disconnect.
+    """
+    return {
+        "availability": [{"topic": topic}, status_availability],
+        "availability_mode": "all",
     }
-    return conf
 
 
-def publish_ha_config():
+def build_ha_config_messages():
+    """
+    Build Home Assistant discovery messages once.
+    All inputs are fixed at startup, so every reconnect can reuse the serialized payloads.
+    """
     start_conf = {
-        "device": get_device_conf(),
+        "device": device_conf,
         "icon": "mdi:radiator",
         "name": "Start",
         "unique_id": f"{device_id}-000",
-        "command_topic": f"{mqtt_prefix}/start/cmd",
-        "availability_topic": f"{mqtt_prefix}/start/av",
+        "command_topic": topic_start_cmd,
+        **control_availability(topic_start_av),
         "enabled_by_default": True,
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/button/{device_id}-000/config",
-        json.dumps(start_conf),
-        retain=True,
-    )
-
     stop_conf = {
-        "device": get_device_conf(),
+        "device": device_conf,
         "icon": "mdi:radiator-off",
         "name": "Stop",
         "unique_id": f"{device_id}-001",
-        "command_topic": f"{mqtt_prefix}/stop/cmd",
-        "availability_topic": f"{mqtt_prefix}/stop/av",
+        "command_topic": topic_stop_cmd,
+        **control_availability(topic_stop_av),
         "enabled_by_default": True,
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/button/{device_id}-001/config",
-        json.dumps(stop_conf),
-        retain=True,
-    )
-
     status_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
+        "expire_after": sensor_expire_after,
         "name": "Status",
         "unique_id": f"{device_id}-010",
-        "state_topic": f"{mqtt_prefix}/status/state",
+        "state_topic": topic_status_state,
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-010/config",
-        json.dumps(status_conf),
-        retain=True,
-    )
-
     temperature_limiting_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
         "name": "Temperature Limiting",
         "unique_id": f"{device_id}-023",
-        "state_topic": f"{mqtt_prefix}/temp_limiting/state",
+        # Edge-triggered, so they cannot expire - unavailable while the status reports the heater unreachable
+        "availability": [status_availability],
+        "state_topic": topic_temp_limiting_state,
         "icon": "mdi:thermometer-alert",
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-023/config",
-        json.dumps(temperature_limiting_conf),
-        retain=True,
-    )
-
     overheat_protection_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
         "name": "Overheat Protection",
         "unique_id": f"{device_id}-024",
-        "state_topic": f"{mqtt_prefix}/overheat/state",
+        "availability": [status_availability],
+        "state_topic": topic_overheat_state,
         "icon": "mdi:fire-alert",
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-024/config",
-        json.dumps(overheat_protection_conf),
-        retain=True,
-    )
-
     room_temperature_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
+        "expire_after": sensor_expire_after,
         "name": "Room temperature",
         "device_class": "temperature",
         "unit_of_measurement": "°C",
         "icon": "mdi:home-thermometer",
         "unique_id": f"{device_id}-011",
-        "state_topic": f"{mqtt_prefix}/room_temperature/state",
+        **sensor_state(topic_room_temperature_state, "cab_temperature"),
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-011/config",
-        json.dumps(room_temperature_conf),
-        retain=True,
-    )
-
     heater_temperature_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
+        "expire_after": sensor_expire_after,
         "name": "Heater temperature",
         "device_class": "temperature",
         "unit_of_measurement": "°C",
         "icon": "mdi:thermometer-lines",
         "unique_id": f"{device_id}-012",
-        "state_topic": f"{mqtt_prefix}/heater_temperature/state",
+        **sensor_state(topic_heater_temperature_state, "case_temperature"),
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-012/config",
-        json.dumps(heater_temperature_conf),
-        retain=True,
-    )
-
     voltage_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
+        "expire_after": sensor_expire_after,
         "name": "Supply voltage",
         "device_class": "voltage",
         "unit_of_measurement": "V",
         "icon": "mdi:car-battery",
         "unique_id": f"{device_id}-013",
-        "state_topic": f"{mqtt_prefix}/voltage/state",
+        **sensor_state(topic_voltage_state, "supply_voltage"),
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-013/config",
-        json.dumps(voltage_conf),
-        retain=True,
-    )
-
     altitude_conf = {
-        "device": get_device_conf(),
-        "expire_after": 10,
+        "device": device_conf,
+        "expire_after": sensor_expire_after,
         "name": "Altitude",
         "device_class": "distance",
         "unit_of_measurement": "m",
         "icon": "mdi:summit",
         "unique_id": f"{device_id}-014",
-        "state_topic": f"{mqtt_prefix}/altitude/state",
+        **sensor_state(topic_altitude_state, "altitude"),
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/sensor/{device_id}-014/config",
-        json.dumps(altitude_conf),
-        retain=True,
-    )
-
     mode_select_conf = {
-        "device": get_device_conf(),
+        "device": device_conf,
         "name": "Mode",
-        "availability_topic": f"{mqtt_prefix}/mode/av",
-        "command_topic": f"{mqtt_prefix}/mode/cmd",
-        "state_topic": f"{mqtt_prefix}/mode/state",
+        **control_availability(topic_mode_av),
+        "command_topic": topic_mode_cmd,
+        "state_topic": topic_mode_state,
         "enabled_by_default": True,
         "unique_id": f"{device_id}-021",
         "options": modes
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/select/{device_id}-021/config",
-        json.dumps(mode_select_conf),
-        retain=True,
-    )
-
     level_conf = {
-        "device": get_device_conf(),
+        "device": device_conf,
         "name": "Power Level",
-        "availability_topic": f"{mqtt_prefix}/level/av",
-        "command_topic": f"{mqtt_prefix}/level/cmd",
-        "state_topic": f"{mqtt_prefix}/level/state",
+        **control_availability(topic_level_av),
+        "command_topic": topic_level_cmd,
+        "state_topic": topic_level_state,
         "enabled_by_default": True,
         "icon": "mdi:speedometer",
         "unique_id": f"{device_id}-020",
@@ -302,18 +365,12 @@ def publish_ha_config():
         "max": 10.0,
         "step": 1.0,
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/number/{device_id}-020/config",
-        json.dumps(level_conf),
-        retain=True,
-    )
-    
     temperature_conf = {
-        "device": get_device_conf(),
+        "device": device_conf,
         "name": "Temperature",
-        "availability_topic": f"{mqtt_prefix}/temperature/av",
-        "command_topic": f"{mqtt_prefix}/temperature/cmd",
-        "state_topic": f"{mqtt_prefix}/temperature/state",
+        **control_availability(topic_temperature_av),
+        "command_topic": topic_temperature_cmd,
+        "state_topic": topic_temperature_state,
         "enabled_by_default": True,
         "icon": "mdi:thermometer",
         "unique_id": f"{device_id}-022",
@@ -321,11 +378,34 @@ def publish_ha_config():
         "max": 36.0,
         "step": 1.0,
     }
-    client.publish(
-        f"{mqtt_discovery_prefix}/number/{device_id}-022/config",
-        json.dumps(temperature_conf),
-        retain=True,
-    )   
+    return [
+        (f"{mqtt_discovery_prefix}/button/{device_id}-000/config", json_dumps(start_conf)),
+        (f"{mqtt_discovery_prefix}/button/{device_id}-001/config", json_dumps(stop_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-010/config", json_dumps(status_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-023/config", json_dumps(temperature_limiting_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-024/config", json_dumps(overheat_protection_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-011/config", json_dumps(room_temperature_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-012/config", json_dumps(heater_temperature_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-013/config", json_dumps(voltage_conf)),
+        (f"{mqtt_discovery_prefix}/sensor/{device_id}-014/config", json_dumps(altitude_conf)),
+        (f"{mqtt_discovery_prefix}/select/{device_id}-021/config", json_dumps(mode_select_conf)),
+        (f"{mqtt_discovery_prefix}/number/{device_id}-020/config", json_dumps(level_conf)),
+        (f"{mqtt_discovery_prefix}/number/{device_id}-022/config", json_dumps(temperature_conf)),
+    ]
+
+
+ha_config_messages = build_ha_config_messages()
+
+
+def publish_ha_config():
+    """
+    Publish discovery messages back-to-back.
+    Called from on_connect, i.e. on paho's network thread, so the whole batch is queued
+    before the thread returns to its write loop and gets flushed in a single pass.
+    """
+    for topic, payload in ha_config_messages:
+        client.publish(topic, payload, retain=True)
+
 
 def on_connect(client, userdata, flags, rc):
     global run
@@ -335,157 +415,308 @@ def on_connect(client, userdata, flags, rc):
     logger.info("Connected to MQTT broker")
     client.subscribe(
         [
-            (f"{mqtt_prefix}/start/cmd", 2),
-            (f"{mqtt_prefix}/stop/cmd", 2),
-            (f"{mqtt_prefix}/level/cmd", 2),
-            (f"{mqtt_prefix}/temperature/cmd", 2),
-            (f"{mqtt_prefix}/mode/cmd", 2),
+            (topic_start_cmd, 2),
+            (topic_stop_cmd, 2),
+            (topic_level_cmd, 2),
+            (topic_temperature_cmd, 2),
+            (topic_mode_cmd, 2),
         ]
     )
     publish_ha_config()
-    # Initialize temperature limiting and overheat protection sensors
-    client.publish(f"{mqtt_prefix}/temp_limiting/state", "Inactive")
-    client.publish(f"{mqtt_prefix}/overheat/state", "Inactive")
+    # Initialize temperature limiting and overheat protection sensors with the current state
+    publish_cached(topic_temp_limiting_state, heater_state.temp_limiting_msg, retain=True)
+    publish_cached(topic_overheat_state, heater_state.overheat_msg, retain=True)
 
 
 def on_disconnect(client, userdata, rc):
     """
     This callback is called when the client disconnects from the broker.
     An rc (result code) different from 0 usually indicates an unexpected disconnect.
-    Paho MQTT with loop_start() will auto-reconnect, but we log and assist if needed.
+    Paho MQTT with loop_start() will auto-reconnect, so this only logs and resets the publish cache.
     """
+    global mqtt_disconnects
     if rc == 0:
         logger.info("Disconnected from MQTT broker (clean disconnect)")
     else:
-        logger.warning(f"Unexpected disconnect from MQTT broker (rc={rc}), auto-reconnect will attempt...")
+        mqtt_disconnects += 1
+        logger.warning("Unexpected disconnect from MQTT broker (rc=%s, disconnects so far: %s), auto-reconnect will attempt...", rc, mqtt_disconnects)
         # Paho's loop_start() handles reconnection automatically
         # on_connect will be called again when reconnected, which will re-publish HA config
+    # Broker may have lost non-retained state - publish everything again after reconnect
+    last_published.clear()
+
+
+def encode_payload(value):
+    """Encode a state value to payload bytes, so paho does not have to convert it"""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return b"%.1f" % value  # supply voltage, reported with 0.1 V resolution
+    return b"%d" % value
+
+
+def publish_system_state():
+    """
+    Publish system_state from the BLE error paths, skipped while the broker is unreachable.
+    Cascading errors that end in the same state publish it once; an unchanged state is only
+    re-sent every status_refresh_interval, so the status sensor does not expire during an outage.
+    The heater cannot take commands here, so its controls are marked offline - sent once, repeats hit the publish cache.
+    """
+    global status_sent_at
+    if client.is_connected():
+        payload = sys_state_payloads[system_state]
+        now = time.monotonic()
+        if last_published.get(topic_status_state) == payload and now - status_sent_at < status_refresh_interval:
+            return
+        # Same QoS and retain as the polled status, so late subscribers see the current state
+        if client.publish(topic_status_state, payload, qos=1, retain=True).rc == mqtt.MQTT_ERR_SUCCESS:
+            last_published[topic_status_state] = payload
+            status_sent_at = now
+        publish_many(availability_offline)
+
+
+def wait_for_reconnect(delay):
+    """Wait out a reconnect backoff, refreshing the error status meanwhile. Returns early on shutdown."""
+    deadline = time.monotonic() + delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or shutdown_requested.wait(min(remaining, status_refresh_interval)):
+            return
+        publish_system_state()
 
 
-def dispatch_result(result):
-    global system_state, mqtt_publish_failures
-    stop_pub = False
-    start_pub = False
-    level_pub = False
-    temperature_pub = False
-    mode_pub = False
+def compute_publications(result, system_state):
+    """
+    Build the messages for a status result as (topic, payload, qos, retain) tuples.
+    Pure function - publishing, change detection and failure accounting are done by publish_many().
+    """
+    publications = []
+    append = publications.append
+    online = set()  # availability topics that should be online after this result
     if result:
-        logger.debug(str(result.data()))
+        step = result.running_step
+        mode = result.running_mode
         msg = result.running_step_msg
         if result.error:
             msg = f"{msg} ({result.error_msg})"
 
         # Add system state ONLY for connection issues (not for temperature limiting or overheat)
-        if system_state != "Connected" and not system_state.startswith("Temperature limiting") and system_state != "Overheat Active":
-            msg = f"{msg} [{system_state}]"
+        if system_state != SysState.CONNECTED:
+            msg = f"{msg} [{sys_state_names[system_state]}]"
+
+        # QoS 1, never waited on. Retained, so it replaces the "Offline" will after a restart
+        append((topic_status_state, encode_payload(msg), 1, True))
+        # Retained, so a new subscriber gets the latest readings right away
+        append((topic_state, json_dumps(result.data()), 0, True))
+        if mqtt_legacy_topics:
+            append((topic_room_temperature_state, encode_payload(result.cab_temperature), 0, False))
+        if mode:
+            online.add(topic_mode_av)
+            append((topic_mode_state, encode_payload(modes[mode - 1]), 0, False))
+        if step:
+            if mqtt_legacy_topics:
+                append((topic_voltage_state, encode_payload(result.supply_voltage), 0, False))
+                append((topic_altitude_state, encode_payload(result.altitude), 0, False))
+                append((topic_heater_temperature_state, encode_payload(result.case_temperature), 0, False))
+            append((topic_level_state, encode_payload(result.set_level), 0, False))
+            set_temperature = result.set_temperature
+            if set_temperature is not None:
+                append((topic_temperature_state, encode_payload(set_temperature), 0, False))
+            if ((mode == 0) or (mode == 1)) and (step < 4):
+                online.add(topic_level_av)
+            if mode == 2:
+                online.add(topic_temperature_av)
+            if (step > 0) and (step < 4):
+                online.add(topic_stop_av)
+        else:
+            online.add(topic_start_av)
+    # Availability is retained, so Home Assistant picks it up after its own restart.
+    # QoS 0: the values are idempotent and re-sent whenever they change, no PUBACK needed
+    for topic in availability_topics:
+        append((topic, b"online" if topic in online else b"offline", 0, True))
+    return publications
 
-        logger.debug(f"Publishing status: '{msg}' (system_state: '{system_state}')")
-        try:
-            info = client.publish(f"{mqtt_prefix}/status/state", msg, qos=1)
-            r = info.wait_for_publish(5)
-            if not r:
-                logger.debug("Publish successful (ACK received)")
-                mqtt_publish_failures = 0  # Reset failure counter on success
-            else:
-                # If wait_for_publish() returns True, that indicates a timeout or failure
-                mqtt_publish_failures += 1
-                logger.warning(f"MQTT publish timeout/failure (count: {mqtt_publish_failures}/{max_mqtt_publish_failures})")
 
+def publish_many(publications):
+    """
+    Publish computed messages back-to-back.
+    Unchanged payloads are skipped, except for sensors that expire and must be refreshed every poll.
+    """
+    attempted = 0
+    failed = 0
+    publish = client.publish
+    for topic, payload, qos, retain in publications:
+        if topic not in expiring_topics and last_published.get(topic) == payload:
+            continue
+        attempted += 1
+        try:
+            info = publish(topic, payload, qos=qos, retain=retain)
         except Exception as e:
-            mqtt_publish_failures += 1
-            logger.warning(f"MQTT publish exception: {e} (count: {mqtt_publish_failures}/{max_mqtt_publish_failures})")
-
-        client.publish(f"{mqtt_prefix}/room_temperature/state", result.cab_temperature)
-        if result.running_mode:
-            client.publish(f"{mqtt_prefix}/mode/av", "online")
-            client.publish(f"{mqtt_prefix}/mode/state", modes[result.running_mode - 1])
-            mode_pub = True
-        if result.running_step:
-            client.publish(f"{mqtt_prefix}/voltage/state", result.supply_voltage)
-            client.publish(f"{mqtt_prefix}/altitude/state", result.altitude)
-            client.publish(
-                f"{mqtt_prefix}/heater_temperature/state", result.case_temperature
-            )
-            client.publish(f"{mqtt_prefix}/level/state", result.set_level)
-            if result.set_temperature is not None:
-                client.publish(f"{mqtt_prefix}/temperature/state", result.set_temperature)
-            if ((result.running_mode == 0) or (result.running_mode == 1)) and (result.running_step < 4):
-                client.publish(f"{mqtt_prefix}/level/av", "online")
-                level_pub = True
-            if result.running_mode == 2:
-                client.publish(f"{mqtt_prefix}/temperature/av", "online")
-                temperature_pub = True
-            if (result.running_step > 0) and (result.running_step < 4):
-                client.publish(f"{mqtt_prefix}/stop/av", "online")
-                stop_pub = True
+            logger.warning("MQTT publish exception on %s: %s", topic, e)
+            failed += 1
+            continue
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            last_published[topic] = payload
         else:
-            client.publish(f"{mqtt_prefix}/start/av", "online")
-            start_pub = True
-    if not stop_pub:
-        client.publish(f"{mqtt_prefix}/stop/av", "offline")
-    if not start_pub:
-        client.publish(f"{mqtt_prefix}/start/av", "offline")
-    if not level_pub:
-        client.publish(f"{mqtt_prefix}/level/av", "offline")
-    if not temperature_pub:
-        client.publish(f"{mqtt_prefix}/temperature/av", "offline")
-    if not mode_pub:
-        client.publish(f"{mqtt_prefix}/mode/av", "offline")
+            failed += 1
+
+    if failed:
+        logger.warning("MQTT publish failure: %s/%s messages", failed, attempted)
+
+
+def publish_cached(topic, payload, qos=0, retain=False):
+    """Publish a single value outside the poll batch, through the same change cache as publish_many()"""
+    if last_published.get(topic) == payload:
+        return
+    if client.publish(topic, payload, qos=qos, retain=retain).rc == mqtt.MQTT_ERR_SUCCESS:
+        last_published[topic] = payload
+
+
+def dispatch_result(result, extra_publications=()):
+    """Publish a status result, together with any other messages from the same poll, as one batch"""
+    if not result:
+        # No answer to a command - sensors expire on their own, availability is handled by publish_system_state()
+        return
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", result.data())
+    publications = compute_publications(result, system_state)
+    publications.extend(extra_publications)
+    publish_many(publications)
+
+
+def queue_command(cmd, arg):
+    command_queue.put((cmd, arg))
+    poll_wake.set()
+
+
+def queue_start_command(payload):
+    logger.info("Queuing START command")
+    queue_command("start", None)
+
+
+def queue_stop_command(payload):
+    logger.info("Queuing STOP command")
+    queue_command("stop", None)
+
+
+def queue_level_command(payload):
+    requested_level = int(payload)
+    max_allowed = get_max_allowed_level(heater_state.case_temperature)
+
+    if requested_level > max_allowed:
+        # Reduce to max allowed instead of ignoring completely
+        if time.monotonic() - heater_state.last_level_limit_warning > 30:
+            logger.warning("Level %s reduced to %s due to temperature limit (temp: %s°C)", requested_level, max_allowed, heater_state.case_temperature)
+        requested_level = max_allowed
+
+    # Only send command if level actually changed - prevents MQTT spam
+    if requested_level == heater_state.heater_level:
+        logger.debug("Level %s already set, skipping redundant command", requested_level)
+        return
+
+    logger.info("Queuing LEVEL=%s command (temp: %s°C)", requested_level, heater_state.case_temperature)
+    queue_command("level", requested_level)
+
+
+def queue_temperature_command(payload):
+    logger.info("Queuing TEMPERATURE=%s command", int(payload))
+    queue_command("temperature", int(payload))
+
+
+def queue_mode_command(payload):
+    mode = mode_numbers.get(payload)
+    if mode is None:
+        logger.warning("Ignoring unknown mode %r", payload)
+        return
+    logger.info("Queuing MODE=%s command", payload)
+    queue_command("mode", mode)
+
+
+# Command topic -> handler, looked up once per incoming message
+command_handlers = {
+    topic_start_cmd: queue_start_command,
+    topic_stop_cmd: queue_stop_command,
+    topic_level_cmd: queue_level_command,
+    topic_temperature_cmd: queue_temperature_command,
+    topic_mode_cmd: queue_mode_command,
+}
+# Commands rejected during overheat lockout - start/stop always go through
+lockout_topics = frozenset((topic_level_cmd, topic_temperature_cmd, topic_mode_cmd))
 
 
 # The callback for when a PUBLISH message is received from the server.
 # NEVER call BLE operations here - bluepy is not thread-safe.
 # Instead, enqueue commands for the main loop to process.
 def on_message(client, userdata, msg):
-    global overheat_active, overheat_start_time, current_case_temperature
-
     # Check if device is connected
     if vdh is None:
-        logger.warning(f"Command received while device disconnected: {msg.topic}")
-        client.publish(f"{mqtt_prefix}/status/state", "Disconnected - command ignored")
+        logger.warning("Command received while device disconnected: %s", msg.topic)
+        # Through the cache, so the next error-path status is not mistaken for a repeat
+        publish_cached(topic_status_state, b"Disconnected - command ignored", qos=1, retain=True)
         return
 
-    # Check if overheat protection is active and blocking commands
-    if overheat_active:
-        time_remaining = overheat_lockout_time - (time.time() - overheat_start_time)
+    # Block level/temperature/mode changes during overheat lockout
+    if heater_state.overheat_active and msg.topic in lockout_topics:
+        time_remaining = heater_state.lockout_remaining(time.monotonic())
         if time_remaining > 0:
-            # Block level/temperature/mode changes during overheat lockout
-            if msg.topic in [f"{mqtt_prefix}/level/cmd", f"{mqtt_prefix}/temperature/cmd", f"{mqtt_prefix}/mode/cmd"]:
-                logger.warning(f"Command blocked due to overheat protection (lockout: {time_remaining:.0f}s remaining)")
-                # Publish lockout status to overheat sensor, not main status
-                client.publish(f"{mqtt_prefix}/overheat/state", f"LOCKOUT: {time_remaining:.0f}s remaining")
-                return
-
-    if msg.topic == f"{mqtt_prefix}/start/cmd":
-        logger.info("Queuing START command")
-        command_queue.put(("start", None))
-    elif msg.topic == f"{mqtt_prefix}/stop/cmd":
-        logger.info("Queuing STOP command")
-        command_queue.put(("stop", None))
-    elif msg.topic == f"{mqtt_prefix}/level/cmd":
-        requested_level = int(msg.payload)
-        max_allowed = get_max_allowed_level(current_case_temperature)
-
-        if requested_level > max_allowed:
-            # Reduce to max allowed instead of ignoring completely
-            if time.time() - last_level_limit_warning > 30:
-                logger.warning(f"Level {requested_level} reduced to {max_allowed} due to temperature limit (temp: {current_case_temperature}°C)")
-            requested_level = max_allowed
-
-        # Only send command if level actually changed - prevents MQTT spam
-        if requested_level == current_heater_level:
-            logger.debug(f"Level {requested_level} already set, skipping redundant command")
+            logger.warning("Command blocked due to overheat protection (lockout: %.0fs remaining)", time_remaining)
+            # Publish lockout status to overheat sensor, not main status
+            # Kept as the sensor's current value, so polls do not overwrite it until the lockout ends
+            heater_state.overheat_msg = b"LOCKOUT: %.0fs remaining" % time_remaining
+            publish_cached(topic_overheat_state, heater_state.overheat_msg, retain=True)
             return
 
-        logger.info(f"Queuing LEVEL={requested_level} command (temp: {current_case_temperature}°C)")
-        command_queue.put(("level", requested_level))
-    elif msg.topic == f"{mqtt_prefix}/temperature/cmd":
-        logger.info(f"Queuing TEMPERATURE={int(msg.payload)} command")
-        command_queue.put(("temperature", int(msg.payload)))
-    elif msg.topic == f"{mqtt_prefix}/mode/cmd":
-        logger.info(f"Queuing MODE={msg.payload} command")
-        command_queue.put(("mode", msg.payload.decode('ascii')))
-    logger.debug(f"{msg.topic} {str(msg.payload)}")
+    handler = command_handlers.get(msg.topic)
+    if handler is not None:
+        handler(msg.payload)
+    logger.debug("%s %s", msg.topic, msg.payload)
+
+
+def execute_start(arg):
+    logger.info("Executing START command")
+    dispatch_result(vdh.start())
+
+
+def execute_stop(arg):
+    logger.info("Executing STOP command")
+    dispatch_result(vdh.stop())
+
+
+def execute_level(level):
+    # Re-check temperature limit at execution time
+    max_allowed = get_max_allowed_level(heater_state.case_temperature)
+    if level > max_allowed:
+        if time.monotonic() - heater_state.last_level_limit_warning > 30:
+            logger.warning("Level %s reduced to %s at execution time (temp: %s°C)", level, max_allowed, heater_state.case_temperature)
+            heater_state.last_level_limit_warning = time.monotonic()
+        level = max_allowed
+    if level == heater_state.heater_level:
+        logger.debug("Level %s already set at execution time, skipping", level)
+        return
+    logger.info("Executing LEVEL=%s command", level)
+    dispatch_result(vdh.set_level(level))
+
+
+def execute_temperature(arg):
+    logger.info("Executing TEMPERATURE=%s command", arg)
+    dispatch_result(vdh.set_level(arg))
+
+
+def execute_mode(arg):
+    logger.info("Executing MODE=%s command", arg)
+    dispatch_result(vdh.set_mode(arg))
+
+
+# Queued command name -> executor, run on the main loop thread
+command_executors = {
+    "start": execute_start,
+    "stop": execute_stop,
+    "level": execute_level,
+    "temperature": execute_temperature,
+    "mode": execute_mode,
+}
 
 
 def process_command_queue():
@@ -493,7 +724,6 @@ def process_command_queue():
     Process pending commands from the queue.
     Called from main loop thread - safe to use BLE here.
     """
-    global last_level_limit_warning
     processed = 0
     while not command_queue.empty() and processed < 5:
         try:
@@ -503,50 +733,36 @@ def process_command_queue():
 
         processed += 1
         try:
-            if cmd == "start":
-                logger.info("Executing START command")
-                dispatch_result(vdh.start())
-            elif cmd == "stop":
-                logger.info("Executing STOP command")
-                dispatch_result(vdh.stop())
-            elif cmd == "level":
-                # Re-check temperature limit at execution time
-                max_allowed = get_max_allowed_level(current_case_temperature)
-                level = arg
-                if level > max_allowed:
-                    if time.time() - last_level_limit_warning > 30:
-                        logger.warning(f"Level {level} reduced to {max_allowed} at execution time (temp: {current_case_temperature}°C)")
-                        last_level_limit_warning = time.time()
-                    level = max_allowed
-                if level == current_heater_level:
-                    logger.debug(f"Level {level} already set at execution time, skipping")
-                    continue
-                logger.info(f"Executing LEVEL={level} command")
-                dispatch_result(vdh.set_level(level))
-            elif cmd == "temperature":
-                logger.info(f"Executing TEMPERATURE={arg} command")
-                dispatch_result(vdh.set_level(arg))
-            elif cmd == "mode":
-                logger.info(f"Executing MODE={arg} command")
-                dispatch_result(vdh.set_mode(modes.index(arg) + 1))
+            command_executors[cmd](arg)
         except Exception as e:
-            logger.error(f"Error executing queued command '{cmd}': {e}")
+            logger.error("Error executing queued command '%s': %s", cmd, e)
             raise
 
 
+def handle_shutdown_signal(signum, frame):
+    global run
+    logger.info("Received signal %s, shutting down", signum)
+    run = False
+    shutdown_requested.set()
+    poll_wake.set()
+
+
 def on_publish(client, userdata, mid):
     """
     This callback is called when a publish message has completed delivery to the broker.
     You can track message IDs (mid) here if you need to confirm each publish.
     """
-    # logger.debug(f"on_publish() mid = {mid}")  # Too much noise, uncomment if needed
+    # logger.debug("on_publish() mid = %s", mid)  # Too much noise, uncomment if needed
     pass
 
 
 logger = init_logger()
+# Long-running loop allocates many short-lived objects - collect younger generations less often
+gc.set_threshold(7000, 10, 10)
 client = init_client()
 vdh = None
-client.loop_start()
+signal.signal(signal.SIGTERM, handle_shutdown_signal)
+signal.signal(signal.SIGINT, handle_shutdown_signal)
 
 # Connection retry settings
 max_reconnect_attempts = 5
@@ -554,34 +770,45 @@ reconnect_delay = 2  # seconds - faster reconnect attempts
 reconnect_attempt = 0
 failed_reconnects_total = 0  # Track total failed reconnects for BLE reset
 ble_reset_threshold = 5  # Reset BLE adapter after this many failed reconnects (faster reset)
+max_reconnect_delay = 30  # seconds - cap for the growing wait between reconnects
+
+
+def reconnect_backoff(failures):
+    """Wait after the Nth failure in a row: about reconnect_delay after the first, doubling up to max_reconnect_delay"""
+    return vevor.backoff_delay(reconnect_delay, max(failures - 1, 0), max_reconnect_delay)
+
 
 # Watchdog settings
-last_successful_poll = time.time()
+last_successful_poll = time.monotonic()
 watchdog_timeout = 10  # seconds - faster detection of connection loss (was 30s)
 consecutive_failures = 0
 max_consecutive_failures = 2  # reconnect after 2 consecutive failures (faster reaction)
 
-# MQTT health check
-last_mqtt_health_check = time.time()
-mqtt_health_check_interval = 60  # seconds - check MQTT health every minute
-mqtt_publish_failures = 0
-max_mqtt_publish_failures = 3  # reconnect MQTT after 3 failed publishes
+# Periodic status logging (deadlines, so each fires once per interval)
+health_log_interval = 30  # seconds
+next_health_log_at = time.monotonic() + health_log_interval
+overheat_error_log_interval = 60  # seconds - while heater reports error 5
 
 # Overheat protection settings
 overheat_threshold = int(os.environ.get("OVERHEAT_THRESHOLD", 256))  # °C - critical temperature
 overheat_lockout_time = 60  # seconds - initial lockout period
 overheat_extended_lockout = 300  # seconds - extended lockout if temp still rising
-overheat_active = False
-overheat_start_time = 0
-overheat_last_temp = 0  # Track temperature trend
-overheat_temp_rising_count = 0  # Count how many times temp rose during lockout
 
 # Temperature-based level limiting
 temp_limiting_enabled = os.environ.get("TEMP_LEVEL_LIMITING", "true").lower() in ["true", "1", "yes"]
-current_case_temperature = 0  # Track current temperature for level limiting
-current_heater_level = 0  # Track current heater level to prevent redundant commands
-last_level_limit_warning = 0  # Timestamp of last level limit warning (to avoid spam)
-last_max_allowed_level = 36  # Track max allowed level to detect changes
+
+# Progressive level limits: from each threshold upward, level is capped at the
+# matching entry (e.g. >= overheat_threshold - 11 -> 10, >= overheat_threshold -> 1)
+level_limit_thresholds = (
+    overheat_threshold - 11,  # 245°C (default) - getting warm, minor limitation
+    overheat_threshold - 8,  # 248°C (default) - warm, slightly limited
+    overheat_threshold - 5,  # 251°C (default) - elevated, moderately limited
+    overheat_threshold - 3,  # 253°C (default) - high, significantly limited
+    overheat_threshold - 1,  # 255°C (default) - very high, severely limited
+    overheat_threshold,  # critical - force minimum
+)
+level_limits = (36, 10, 8, 6, 4, 2, 1)  # one more than thresholds: 36 = safe, no limitation
+
 
 def get_max_allowed_level(temperature):
     """
@@ -591,237 +818,307 @@ def get_max_allowed_level(temperature):
     """
     if not temp_limiting_enabled:
         return 36  # Limiting disabled - no restriction
+    return level_limits[bisect.bisect_right(level_limit_thresholds, temperature)]
 
-    if temperature >= overheat_threshold:
-        return 1  # Critical - force minimum
-    elif temperature >= overheat_threshold - 1:  # 255°C (default)
-        return 2  # Very high - severely limited
-    elif temperature >= overheat_threshold - 3:  # 253°C (default)
-        return 4  # High - significantly limited
-    elif temperature >= overheat_threshold - 5:  # 251°C (default)
-        return 6  # Elevated - moderately limited
-    elif temperature >= overheat_threshold - 8:  # 248°C (default)
-        return 8  # Warm - slightly limited
-    elif temperature >= overheat_threshold - 11:  # 245°C (default)
-        return 10  # Getting warm - minor limitation
-    else:
-        return 36  # Safe - no limitation
+
+@dataclass
+class HeaterState:
+    """
+    Temperature tracking, level limiting and overheat protection state.
+    Updated from the main loop on every successful status poll, read by MQTT command handlers.
+    """
+    case_temperature: int = 0  # Track current temperature for level limiting
+    heater_level: int = 0  # Track current heater level to prevent redundant commands
+    max_allowed_level: int = 36  # Track max allowed level to detect changes
+    last_level_limit_warning: float = 0  # Timestamp of last level limit warning (to avoid spam)
+    overheat_active: bool = False
+    overheat_start_time: float = 0
+    overheat_last_temp: int = 0  # Track temperature trend
+    overheat_temp_rising_count: int = 0  # Count how many times temp rose during lockout
+    next_overheat_error_log_at: float = 0
+    temp_limiting_msg: bytes = b"Inactive"  # Current payloads of the temperature limiting and overheat sensors
+    overheat_msg: bytes = b"Inactive"
+
+    def overheat_lockout(self):
+        """Current lockout period - extended if temperature kept rising at level 1"""
+        if self.overheat_temp_rising_count >= 3:
+            return overheat_extended_lockout
+        return overheat_lockout_time
+
+    def lockout_remaining(self, now):
+        """Seconds left until level/temperature/mode commands are accepted again"""
+        if not self.overheat_active:
+            return 0
+        return self.overheat_lockout() - (now - self.overheat_start_time)
+
+    def _activate_overheat(self, temperature, now):
+        self.overheat_active = True
+        self.overheat_start_time = now
+        self.overheat_last_temp = temperature
+        self.overheat_temp_rising_count = 0
+        self.next_overheat_error_log_at = now + overheat_error_log_interval
+
+    def observe(self, result, now):
+        """
+        Update state from a status result.
+        Returns (publications, cut_power): (topic, payload, qos, retain) tuples for the temperature
+        limiting and overheat sensors, and whether power must be reduced to level 1 right away.
+        Both sensors are returned every poll, but they do not expire and are not refreshed:
+        publish_many() only sends them when the value changes. Retained, so Home Assistant
+        still gets the current value after its own restart.
+        """
+        cut_power = False
+        temperature = result.case_temperature
+        self.case_temperature = temperature
+        self.heater_level = result.set_level
+
+        # Update temperature limiting sensor when max allowed level changes
+        max_allowed = get_max_allowed_level(temperature)
+        if max_allowed != self.max_allowed_level:
+            if max_allowed < 36:
+                # Temperature limiting is now active or level changed
+                logger.info("Temperature limiting active: max level %s (temp: %s°C)", max_allowed, temperature)
+                self.temp_limiting_msg = b"Active: max level %d" % max_allowed
+            elif self.max_allowed_level < 36:
+                # Returning to normal from limited state
+                logger.info("Temperature limiting deactivated (temp: %s°C)", temperature)
+                self.temp_limiting_msg = b"Inactive"
+            self.max_allowed_level = max_allowed
+
+        # Check for heater's own overheat error (error code 5)
+        if result.error == 5:  # Overheating error from heater
+            if not self.overheat_active:
+                logger.error("Heater reports OVERHEATING error (code 5), activating protection")
+                logger.warning("Heater may stop responding during cooldown (typically 30 minutes)")
+                self._activate_overheat(temperature, now)
+                self.overheat_msg = b"ACTIVE - Error 5 (Overheating)"
+            elif now >= self.next_overheat_error_log_at:
+                # Heater in error 5 may stop responding - log status periodically
+                self.next_overheat_error_log_at = now + overheat_error_log_interval
+                elapsed_error = now - self.overheat_start_time
+                logger.info("Heater still in error 5 (Overheating) after %.1f minutes", elapsed_error/60)
+
+        # Overheat protection check
+        if self.overheat_active:
+            # Monitor temperature trend during lockout
+            if temperature > self.overheat_last_temp + 2:  # Temp rising by >2°C
+                self.overheat_temp_rising_count += 1
+                logger.warning("Temperature still rising during lockout: %s°C -> %s°C", self.overheat_last_temp, temperature)
+
+                # If temp rose 3+ times, extend lockout significantly
+                if self.overheat_temp_rising_count >= 3:
+                    logger.error("Temperature continues rising despite level 1! Extending lockout to %ss", overheat_extended_lockout)
+
+            self.overheat_last_temp = temperature
+
+            # Check if lockout period has expired
+            elapsed = now - self.overheat_start_time
+            if elapsed >= self.overheat_lockout():
+                logger.info("Overheat lockout period expired after %.0fs, controls re-enabled", elapsed)
+                logger.info("Temperature: %s°C, Level remains at 1 (manual increase required)", temperature)
+                self.overheat_active = False
+                self.overheat_temp_rising_count = 0
+                self.overheat_msg = b"Inactive"
+                # DO NOT restore level automatically - user must manually increase
+
+        elif temperature >= overheat_threshold:
+            # Activate overheat protection
+            logger.error("OVERHEAT DETECTED: case_temperature=%s°C >= %s°C", temperature, overheat_threshold)
+            logger.error("Reducing power to level 1 and locking controls for 60s")
+            self._activate_overheat(temperature, now)
+            self.overheat_msg = encode_payload(f"ACTIVE - Temp {temperature}°C")
+            cut_power = True
+
+        publications = [
+            (topic_temp_limiting_state, self.temp_limiting_msg, 0, True),
+            (topic_overheat_state, self.overheat_msg, 0, True),
+        ]
+        return publications, cut_power
+
+
+heater_state = HeaterState()
 
 # System state tracking
-system_state = "Connected"  # Connected, Reconnecting, Disconnected, Overheat Active, etc.
+system_state = SysState.CONNECTED
+
+# Poll schedule: fixed ticks on the monotonic clock, so polls do not drift by the time each one takes
+next_poll_at = time.monotonic()
+
+# Start the MQTT network thread only now - on_connect reads heater_state
+client.loop_start()
 
 while run:
     try:
         # Initialize or reconnect if needed
         if vdh is None:
-            system_state = "Reconnecting"
-            elapsed_since_disconnect = time.time() - last_successful_poll if last_successful_poll > 0 else 0
-            logger.info(f"Connecting to BLE device {ble_mac_address}... (offline for {elapsed_since_disconnect:.1f}s)")
-            logger.debug(f"Reconnect context: attempt={reconnect_attempt}, total_failures={failed_reconnects_total}, overheat_active={overheat_active}")
+            system_state = SysState.RECONNECTING
+            # Refresh the status right before a connect attempt, which can block for several seconds
+            publish_system_state()
+            elapsed_since_disconnect = time.monotonic() - last_successful_poll if last_successful_poll > 0 else 0
+            logger.info("Connecting to BLE device %s... (offline for %.1fs)", ble_mac_address, elapsed_since_disconnect)
+            logger.debug(
+                "Reconnect context: attempt=%s, total_failures=%s, overheat_active=%s",
+                reconnect_attempt, failed_reconnects_total, heater_state.overheat_active,
+            )
 
             # Reset BLE adapter if too many failures
             if failed_reconnects_total > 0 and failed_reconnects_total % ble_reset_threshold == 0:
-                logger.error(f"BLE adapter reset triggered after {failed_reconnects_total} failed reconnects")
+                logger.error("BLE adapter reset triggered after %s failed reconnects", failed_reconnects_total)
                 reset_ble_adapter()
+                heater = None  # start from scratch, including service discovery
 
             try:
                 # Use 5s timeout for faster failure detection
-                vdh = vevor.DieselHeater(ble_mac_address, ble_passkey, timeout_sec=5)
-                logger.info(f"Successfully connected to BLE device after {elapsed_since_disconnect:.1f}s offline")
-                system_state = "Connected"
+                if heater is None:
+                    heater = vevor.DieselHeater(ble_mac_address, ble_passkey, timeout_sec=5)
+                else:
+                    heater.reconnect(timeout_sec=5)
+                vdh = heater
+                logger.info("Successfully connected to BLE device after %.1fs offline", elapsed_since_disconnect)
+                system_state = SysState.CONNECTED
                 reconnect_attempt = 0
                 failed_reconnects_total = 0  # Reset counter on success
             except Exception as conn_error:
-                logger.error(f"Failed to connect to BLE device: {conn_error}")
+                logger.error("Failed to connect to BLE device: %s", conn_error)
                 failed_reconnects_total += 1
                 # No need to cleanup here - vdh is already None or failed to create
                 vdh = None
                 raise  # Re-raise to be caught by outer exception handlers
 
         # Process queued MQTT commands BEFORE polling (thread-safe BLE access)
+        poll_wake.clear()
         process_command_queue()
 
         # Get status and dispatch
         result = vdh.get_status()
+        now = time.monotonic()  # single timestamp for all checks in this iteration
 
         # Watchdog: check if we got valid result
         if result is not None:
-            last_successful_poll = time.time()
+            last_successful_poll = now
             consecutive_failures = 0
 
-            # Update current temperature and level for tracking
-            current_case_temperature = result.case_temperature
-            current_heater_level = result.set_level
-
-            # Check if temperature limiting status changed
-            current_max_allowed = get_max_allowed_level(current_case_temperature)
-
-            # Update temperature limiting sensor when max allowed level changes
-            if current_max_allowed != last_max_allowed_level:
-                if current_max_allowed < 36:
-                    # Temperature limiting is now active or level changed
-                    temp_limit_msg = f"Active: max level {current_max_allowed}"
-                    logger.info(f"Temperature limiting active: max level {current_max_allowed} (temp: {current_case_temperature}°C)")
-                    client.publish(f"{mqtt_prefix}/temp_limiting/state", temp_limit_msg)
-                elif last_max_allowed_level < 36:
-                    # Returning to normal from limited state
-                    logger.info(f"Temperature limiting deactivated (temp: {current_case_temperature}°C)")
-                    client.publish(f"{mqtt_prefix}/temp_limiting/state", "Inactive")
-                last_max_allowed_level = current_max_allowed
+            publications, cut_power = heater_state.observe(result, now)
 
             # Periodic health check log every 30s
-            if int(time.time()) % 30 == 0:
-                max_allowed = get_max_allowed_level(current_case_temperature)
-                logger.debug(f"Health check OK - temp: {current_case_temperature}°C, level: {result.set_level}, max_allowed: {max_allowed}, step: {result.running_step_msg}, queue: {command_queue.qsize()}")
-
-            # Check for heater's own overheat error (error code 5)
-            if result.error == 5:  # Overheating error from heater
-                if not overheat_active:
-                    logger.error(f"Heater reports OVERHEATING error (code 5), activating protection")
-                    logger.warning(f"Heater may stop responding during cooldown (typically 30 minutes)")
-                    overheat_active = True
-                    overheat_start_time = time.time()
-                    overheat_last_temp = result.case_temperature
-                    overheat_temp_rising_count = 0
-                    client.publish(f"{mqtt_prefix}/overheat/state", f"ACTIVE - Error 5 (Overheating)")
-                else:
-                    # Heater in error 5 may stop responding - log status periodically
-                    elapsed_error = time.time() - overheat_start_time
-                    if int(elapsed_error) % 60 == 0:  # Every minute
-                        logger.info(f"Heater still in error 5 (Overheating) after {elapsed_error/60:.1f} minutes")
-
-            # Overheat protection check
-            if overheat_active:
-                current_lockout = overheat_lockout_time
-
-                # Monitor temperature trend during lockout
-                if result.case_temperature > overheat_last_temp + 2:  # Temp rising by >2°C
-                    overheat_temp_rising_count += 1
-                    logger.warning(f"Temperature still rising during lockout: {overheat_last_temp}°C -> {result.case_temperature}°C")
-
-                    # If temp rose 3+ times, extend lockout significantly
-                    if overheat_temp_rising_count >= 3:
-                        current_lockout = overheat_extended_lockout
-                        logger.error(f"Temperature continues rising despite level 1! Extending lockout to {overheat_extended_lockout}s")
-
-                overheat_last_temp = result.case_temperature
-
-                # Check if lockout period has expired
-                elapsed = time.time() - overheat_start_time
-                if elapsed >= current_lockout:
-                    logger.info(f"Overheat lockout period expired after {elapsed:.0f}s, controls re-enabled")
-                    logger.info(f"Temperature: {result.case_temperature}°C, Level remains at 1 (manual increase required)")
-                    overheat_active = False
-                    overheat_temp_rising_count = 0
-                    client.publish(f"{mqtt_prefix}/overheat/state", "Inactive")
-                    # DO NOT restore level automatically - user must manually increase
-
-            elif result.case_temperature >= overheat_threshold:
-                # Activate overheat protection
-                logger.error(f"OVERHEAT DETECTED: case_temperature={result.case_temperature}°C >= {overheat_threshold}°C")
-                logger.error("Reducing power to level 1 and locking controls for 60s")
-                overheat_active = True
-                overheat_start_time = time.time()
-                overheat_last_temp = result.case_temperature
-                overheat_temp_rising_count = 0
-                client.publish(f"{mqtt_prefix}/overheat/state", f"ACTIVE - Temp {result.case_temperature}°C")
-
+            if now >= next_health_log_at:
+                next_health_log_at = now + health_log_interval
+                logger.debug(
+                    "Health check OK - temp: %s°C, level: %s, max_allowed: %s, step: %s, queue: %s",
+                    heater_state.case_temperature, result.set_level, heater_state.max_allowed_level, result.running_step_msg, command_queue.qsize(),
+                )
+
+            if cut_power:
                 # Immediately reduce power to 1
                 try:
                     vdh.set_level(1)
                 except Exception as e:
-                    logger.error(f"Failed to reduce power during overheat: {e}")
+                    logger.error("Failed to reduce power during overheat: %s", e)
 
-            dispatch_result(result)
+            dispatch_result(result, publications)
         else:
             consecutive_failures += 1
-            time_since_last_poll = time.time() - last_successful_poll
-            logger.warning(f"No response from device (failure {consecutive_failures}/{max_consecutive_failures}, {time_since_last_poll:.1f}s since last success)")
-            logger.debug(f"Debug state: overheat_active={overheat_active}, system_state={system_state}, vdh={vdh is not None}")
+            time_since_last_poll = now - last_successful_poll
+            logger.warning("No response from device (failure %s/%s, %.1fs since last success)", consecutive_failures, max_consecutive_failures, time_since_last_poll)
+            logger.debug(
+                "Debug state: overheat_active=%s, system_state=%s, vdh=%s",
+                heater_state.overheat_active, sys_state_names[system_state], vdh is not None,
+            )
 
             # Check if we exceeded failure threshold
             if consecutive_failures >= max_consecutive_failures:
-                logger.error(f"Device not responding after {max_consecutive_failures} attempts, forcing reconnect")
-                logger.error(f"Last successful poll was {time_since_last_poll:.1f}s ago")
+                logger.error("Device not responding after %s attempts, forcing reconnect", max_consecutive_failures)
+                logger.error("Last successful poll was %.1fs ago", time_since_last_poll)
                 raise RuntimeError("Device not responding - forcing reconnect")
 
-        # Watchdog: check if too much time passed since last successful poll
-        time_since_last_poll = time.time() - last_successful_poll
-        if time_since_last_poll > watchdog_timeout:
-            logger.error(f"WATCHDOG TIMEOUT: no successful poll for {time_since_last_poll:.1f}s (limit {watchdog_timeout}s)")
-            logger.error(f"Debug: consecutive_failures={consecutive_failures}, overheat_active={overheat_active}")
-            logger.error(f"Forcing BLE reconnection...")
-            raise RuntimeError("Watchdog timeout - forcing reconnect")
-
-        # MQTT health check: periodically verify MQTT is working (but don't force reconnect unless truly needed)
-        if time.time() - last_mqtt_health_check >= mqtt_health_check_interval:
-            last_mqtt_health_check = time.time()
-
-            # Only log health check, don't force reconnect
-            # The library's auto-reconnect should handle disconnections
-            if not client.is_connected():
-                logger.warning("MQTT health check: client reports disconnected (waiting for auto-reconnect)")
-            elif mqtt_publish_failures >= max_mqtt_publish_failures:
-                logger.error(f"MQTT health check WARNING: {mqtt_publish_failures} consecutive publish failures")
-            else:
-                logger.debug(f"MQTT health check OK: connected={client.is_connected()}, failures={mqtt_publish_failures}")
-
-        time.sleep(ble_poll_interval)
+            # Watchdog: check if too much time passed since last successful poll
+            # (only on failed polls - a successful one has just reset the timer)
+            if time_since_last_poll > watchdog_timeout:
+                logger.error("WATCHDOG TIMEOUT: no successful poll for %.1fs (limit %ss)", time_since_last_poll, watchdog_timeout)
+                logger.error("Debug: consecutive_failures=%s, overheat_active=%s", consecutive_failures, heater_state.overheat_active)
+                logger.error("Forcing BLE reconnection...")
+                raise RuntimeError("Watchdog timeout - forcing reconnect")
+
+        # Sleep until the next scheduled poll, or until a command gets queued
+        wait_from = time.monotonic()
+        if wait_from >= next_poll_at:
+            next_poll_at += ble_poll_interval
+            if next_poll_at <= wait_from:
+                # Overran (slow poll, reconnect) - start a fresh tick instead of polling back-to-back to catch up
+                next_poll_at = wait_from + ble_poll_interval
+        poll_wake.wait(next_poll_at - wait_from)
 
     except BTLEDisconnectError as e:
-        logger.error(f"BLE disconnected: {e}")
-        logger.error(f"Context: consecutive_failures={consecutive_failures}, time_since_last_poll={time.time() - last_successful_poll:.1f}s")
-        logger.error(f"Overheat: active={overheat_active}, last_temp={overheat_last_temp}°C")
+        logger.error("BLE disconnected: %s", e)
+        logger.error("Context: consecutive_failures=%s, time_since_last_poll=%.1fs", consecutive_failures, time.monotonic() - last_successful_poll)
+        logger.error("Overheat: active=%s, last_temp=%s°C", heater_state.overheat_active, heater_state.overheat_last_temp)
         cleanup_ble_device(vdh)
         vdh = None
-        system_state = "Disconnected"
+        system_state = SysState.DISCONNECTED
         # Publish offline status to MQTT
-        client.publish(f"{mqtt_prefix}/status/state", system_state)
+        publish_system_state()
         reconnect_attempt += 1
 
+        # Short fixed waits: a dropped link usually comes back at once, and _open() already backs off between attempts
         if reconnect_attempt >= max_reconnect_attempts:
-            logger.error(f"Failed to reconnect after {max_reconnect_attempts} attempts")
-            logger.error(f"Resetting reconnect counter and waiting {reconnect_delay * 3}s before retry")
-            system_state = "Connection Failed"
-            client.publish(f"{mqtt_prefix}/status/state", system_state)
+            logger.error("Failed to reconnect after %s attempts", max_reconnect_attempts)
+            logger.error("Resetting reconnect counter and waiting %ss before retry", reconnect_delay * 3)
+            system_state = SysState.CONNECTION_FAILED
+            publish_system_state()
             reconnect_attempt = 0
-            time.sleep(reconnect_delay * 3)  # Wait longer before trying again
+            wait_for_reconnect(reconnect_delay * 3)  # Wait longer before trying again
         else:
-            logger.info(f"Attempting to reconnect in {reconnect_delay}s (attempt {reconnect_attempt}/{max_reconnect_attempts})...")
-            system_state = "Reconnecting"
-            time.sleep(reconnect_delay)
+            logger.info("Attempting to reconnect in %ss (attempt %s/%s)...", reconnect_delay, reconnect_attempt, max_reconnect_attempts)
+            system_state = SysState.RECONNECTING
+            wait_for_reconnect(reconnect_delay)
 
     except TimeoutError as e:
-        logger.error(f"BLE timeout: {e}")
-        logger.error(f"Context: consecutive_failures={consecutive_failures}, time_since_last_poll={time.time() - last_successful_poll:.1f}s")
+        logger.error("BLE timeout: %s", e)
+        logger.error("Context: consecutive_failures=%s, time_since_last_poll=%.1fs", consecutive_failures, time.monotonic() - last_successful_poll)
         cleanup_ble_device(vdh)
         vdh = None
-        system_state = "Timeout"
-        client.publish(f"{mqtt_prefix}/status/state", system_state)
-        logger.info(f"Waiting {reconnect_delay}s before reconnect...")
-        time.sleep(reconnect_delay)
+        system_state = SysState.TIMEOUT
+        publish_system_state()
+        delay = reconnect_backoff(failed_reconnects_total)
+        logger.info("Waiting %.1fs before reconnect...", delay)
+        wait_for_reconnect(delay)
 
     except RuntimeError as e:
         # Watchdog or other runtime errors
-        logger.error(f"Runtime error: {e}")
-        logger.error(f"Context: consecutive_failures={consecutive_failures}, time_since_last_poll={time.time() - last_successful_poll:.1f}s")
-        logger.error(f"Overheat: active={overheat_active}, system_state={system_state}")
+        logger.error("Runtime error: %s", e)
+        logger.error("Context: consecutive_failures=%s, time_since_last_poll=%.1fs", consecutive_failures, time.monotonic() - last_successful_poll)
+        logger.error("Overheat: active=%s, system_state=%s", heater_state.overheat_active, sys_state_names[system_state])
         cleanup_ble_device(vdh)
         vdh = None
-        system_state = "Watchdog Triggered"
-        client.publish(f"{mqtt_prefix}/status/state", system_state)
+        system_state = SysState.WATCHDOG_TRIGGERED
+        publish_system_state()
         consecutive_failures = 0
-        logger.info(f"Waiting {reconnect_delay}s before reconnect...")
-        time.sleep(reconnect_delay)
+        delay = reconnect_backoff(failed_reconnects_total)
+        logger.info("Waiting %.1fs before reconnect...", delay)
+        wait_for_reconnect(delay)
 
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        logger.error(f"Context: consecutive_failures={consecutive_failures}, time_since_last_poll={time.time() - last_successful_poll:.1f}s")
+        logger.error("Unexpected error: %s", e)
+        logger.error("Context: consecutive_failures=%s, time_since_last_poll=%.1fs", consecutive_failures, time.monotonic() - last_successful_poll)
         logger.exception("Full traceback:")
         cleanup_ble_device(vdh)
         vdh = None
-        system_state = "Error"
-        client.publish(f"{mqtt_prefix}/status/state", system_state)
+        system_state = SysState.ERROR
+        publish_system_state()
         consecutive_failures = 0
-        logger.info(f"Waiting {reconnect_delay}s before reconnect...")
-        time.sleep(reconnect_delay)
+        delay = reconnect_backoff(failed_reconnects_total)
+        logger.info("Waiting %.1fs before reconnect...", delay)
+        wait_for_reconnect(delay)
+
+# Graceful shutdown
+cleanup_ble_device(vdh)
+if client.is_connected():
+    # A clean disconnect does not trigger the will - mark the bridge and its controls offline ourselves
+    publish_many(availability_offline)
+    try:
+        client.publish(topic_status_state, b"Offline", qos=1, retain=True).wait_for_publish(2)
+    except Exception as e:
+        logger.warning("Failed to publish offline status: %s", e)
+client.disconnect()
+client.loop_stop()
+logger.info("Bridge stopped")
@@ -1,26 +1,18 @@
 # Vevor BLE Bridge
 # 2024 Bartosz Derleta <bartosz@derleta.com>
 
-import os
-from bluepy.btle import Peripheral, DefaultDelegate, Scanner, BTLEDisconnectError
-import threading
+from bluepy.btle import Peripheral, DefaultDelegate, BTLEDisconnectError
 import time
 import random
-import math
 import struct
 import logging
-import sys
-import multiprocessing
 
+_log = logging.getLogger(__name__)
 
-def _u8tonumber(e):
-    return (e + 256) if (e < 0) else e
 
-
-def _UnsignToSign(e):
-    if e > 32767.5:
-        e = e | -65536
-    return e
+def backoff_delay(base, attempt, max_delay=30):
+    """Truncated exponential backoff with jitter: base for attempt 0, doubling, scaled by 0.5-1.5, capped at max_delay"""
+    return min(max_delay, base * 2 ** min(attempt, 10) * random.uniform(0.5, 1.5))
 
 
 class _DieselHeaterNotification:
@@ -58,68 +50,40 @@ class _DieselHeaterNotification:
         "Cooldown",  # "Shutdown Cooling" # Cooldown
     )
 
+    # Both status variants share this layout: header, running state, error (170/85 only),
+    # running step, altitude, running mode, two setting bytes, voltage, case and cab temperature
+    _status = struct.Struct("<BBxBBBHBBBHhh")
+
     def __init__(self, je):
         # print("< " + je.hex(' ', 1))
-        fb = _u8tonumber(je[0])
-        sb = _u8tonumber(je[1])
-        if (170 == fb) and (85 == sb):
-            self.running_state = _u8tonumber(je[3])  # Is running at all?
-            self.error = _u8tonumber(je[4])
-            self.error_msg = self._error_strings[self.error]
-            self.running_step = _u8tonumber(
-                je[5]
-            )  # Detailed state when running
-            self.running_step_msg = self._running_step_strings[
-                self.running_step
-            ]
-            self.altitude = _u8tonumber(je[6]) + 256 * _u8tonumber(je[7])
-            self.running_mode = _u8tonumber(je[8])  # Temperature / Level mode
-            match self.running_mode:
-                case 0:
-                    self.set_level = _u8tonumber(je[10]) + 1
-                    self.set_temperature = None
-                case 1:
-                    self.set_level = _u8tonumber(je[9])
-                    self.set_temperature = None
-                case 2:
-                    self.set_temperature = _u8tonumber(je[9])
-                    self.set_level = _u8tonumber(je[10]) + 1
-                case _:
-                    raise RuntimeError("Unrecognized running mode")
-            self.supply_voltage = (
-                256 * _u8tonumber(je[12]) + _u8tonumber(je[11])
-            ) / 10
-            self.case_temperature = _UnsignToSign(256 * je[14] + je[13])
-            self.cab_temperature = _UnsignToSign(256 * je[16] + je[15])
-            self.md = 1
-        elif (170 == fb) and (102 == sb):
-            self.running_state = _u8tonumber(je[3])
-            self.error = _u8tonumber(je[17])
-            self.error_msg = self._error_strings_alt[self.error]
-            self.running_step = _u8tonumber(je[5])
-            self.running_step_msg = self._running_step_strings[
-                self.running_step
-            ]
-            self.altitude = _u8tonumber(je[6]) + 256 * _u8tonumber(je[7])
-            self.running_mode = _u8tonumber(je[8])
-            match self.running_mode:
-                case 0:
-                    self.set_level = _u8tonumber(je[10]) + 1
-                    self.set_temperature = None
-                case 1:
-                    self.set_level = _u8tonumber(je[9])
-                    self.set_temperature = None
-                case 2:
-                    self.set_temperature = _u8tonumber(je[9])
-                    self.set_level = _u8tonumber(je[10]) + 1
-                case _:
-                    raise RuntimeError("Unrecognized running mode")
-            self.supply_voltage = (
-                256 * _u8tonumber(je[12]) + _u8tonumber(je[11])
-            ) / 10
-            self.case_temperature = _UnsignToSign(256 * je[14] + je[13])
-            self.cab_temperature = _UnsignToSign(256 * je[16] + je[15])
-            self.md = 3
+        fb = je[0]
+        sb = je[1]
+        if (170 == fb) and ((85 == sb) or (102 == sb)):
+            (
+                _, _,
+                running_state, error, running_step, altitude, running_mode,
+                setting_a, setting_b, supply_voltage, case_temperature, cab_temperature,
+            ) = self._status.unpack_from(je)
+            self.running_state = running_state  # Is running at all?
+            if 85 == sb:
+                self.error = error
+                self.error_msg = self._error_strings[error]
+            else:
+                self.error = je[17]
+                self.error_msg = self._error_strings_alt[self.error]
+            self.running_step = running_step  # Detailed state when running
+            self.running_step_msg = self._running_step_strings[running_step]
+            self.altitude = altitude
+            self.running_mode = running_mode  # Temperature / Level mode
+            if running_mode > 2:
+                raise RuntimeError("Unrecognized running mode")
+            # Level mode (1) sends the level in the first setting byte, the other modes a 0-based level in the second
+            self.set_level = setting_a if running_mode == 1 else setting_b + 1
+            self.set_temperature = setting_a if running_mode == 2 else None
+            self.supply_voltage = supply_voltage / 10
+            self.case_temperature = case_temperature
+            self.cab_temperature = cab_temperature
+            self.md = 1 if 85 == sb else 3
         elif (170 == fb) and (136 == sb):
             raise RuntimeError("Unsupported payload (todo)")
         else:
@@ -141,107 +105,134 @@ class _DieselHeaterDelegate(DefaultDelegate):
 class DieselHeater:
     _service_uuid = "0000ffe0-0000-1000-8000-00805f9b34fb"
     _characteristic_uuid = "0000ffe1-0000-1000-8000-00805f9b34fb"
-    _last_notification = None
+    _command_attempts = 2
+    # 0xAA, mode, passkey (2), command, argument (little endian), checksum
+    _cmd_frame = struct.Struct("<8B")
 
     def __init__(self, mac_address: str, passkey: int, timeout_sec: int = 10, retry_delay: float = 1.0):
         self.mac_address = mac_address
         self.passkey = passkey
+        self._passkey_hi = passkey // 100
+        self._passkey_lo = passkey % 100
+        # Reused for every command - bluepy hex-encodes it before write() returns
+        self._cmd_buf = bytearray(self._cmd_frame.size)
+        self.peripheral = None
+        self.service = None
+        self.characteristic = None
+        self._last_notification = None
+        self._delegate = _DieselHeaterDelegate(self)
+        self._open(timeout_sec, retry_delay)
 
-        start = time.time()
+    def _open(self, timeout_sec, retry_delay):
+        """Connect with retries; service discovery only runs on the first connection"""
+        start = time.monotonic()
+        attempt = 0
         while True:
             try:
                 # English: try to connect
-                self.peripheral = Peripheral(mac_address, "public")
+                if self.peripheral is None:
+                    self.peripheral = Peripheral(self.mac_address, "public")
+                else:
+                    # Same Peripheral object, only the link is re-established
+                    self.peripheral.connect(self.mac_address, "public")
                 break
             except BTLEDisconnectError:
                 # English: if overall timeout exceeded, raise
-                if time.time() - start >= timeout_sec:
+                remaining = start + timeout_sec - time.monotonic()
+                if remaining <= 0:
                     raise TimeoutError(f"BLE connect timed out after {timeout_sec}s")
-                # English: wait before next attempt
-                time.sleep(retry_delay)
-
-        # English: now discover service & characteristic
-        self.service = self.peripheral.getServiceByUUID(self._service_uuid)
-        if self.service is None:
-            raise RuntimeError("Requested service is not supported by peripheral")
-
-        self.characteristic = self.service.getCharacteristics(self._characteristic_uuid)[0]
+                # Wait before next attempt - growing, jittered pauses give the adapter idle time to recover
+                time.sleep(min(backoff_delay(retry_delay, attempt), remaining))
+                attempt += 1
+            except Exception as e:
+                if self.peripheral is None:
+                    raise
+                # The reused Peripheral is broken, e.g. its bluepy-helper died and connect()
+                # fails with BrokenPipeError - start over with a fresh Peripheral and discovery
+                _log.debug("Reusing BLE peripheral failed (%r), creating a new one", e)
+                self.peripheral = None
+                self.service = None
+                self.characteristic = None
+
+        # GATT handles of the heater do not change between connections, so
+        # the characteristic is discovered once and reused after reconnects
         if self.characteristic is None:
-            raise RuntimeError("Requested characteristic is not supported by service")
+            self.service = self.peripheral.getServiceByUUID(self._service_uuid)
+            if self.service is None:
+                raise RuntimeError("Requested service is not supported by peripheral")
 
-        self.peripheral.setDelegate(_DieselHeaterDelegate(self))
+            self.characteristic = self.service.getCharacteristics(self._characteristic_uuid)[0]
+            if self.characteristic is None:
+                raise RuntimeError("Requested characteristic is not supported by service")
+
+        # Peripheral.disconnect() drops the delegate, so it is set on every connection
+        self.peripheral.setDelegate(self._delegate)
+        self._last_notification = None
+        # Bound methods used by every command
+        self._write = self.characteristic.write
+        self._wait = self.peripheral.waitForNotifications
 
     def disconnect(self):
         """Disconnect from the BLE device"""
         try:
-            if hasattr(self, 'peripheral') and self.peripheral:
+            if self.peripheral:
                 self.peripheral.disconnect()
         except Exception:
             pass
 
     def reconnect(self, timeout_sec: int = 10, retry_delay: float = 1.0):
-        """Reconnect to the BLE device"""
+        """Reconnect to the BLE device, reusing the already discovered characteristic"""
         self.disconnect()
-        start = time.time()
-        while True:
-            try:
-                self.peripheral = Peripheral(self.mac_address, "public")
-                break
-            except BTLEDisconnectError:
-                if time.time() - start >= timeout_sec:
-                    raise TimeoutError(f"BLE reconnect timed out after {timeout_sec}s")
-                time.sleep(retry_delay)
-
-        self.service = self.peripheral.getServiceByUUID(self._service_uuid)
-        if self.service is None:
-            raise RuntimeError("Requested service is not supported by peripheral")
-
-        self.characteristic = self.service.getCharacteristics(self._characteristic_uuid)[0]
-        if self.characteristic is None:
-            raise RuntimeError("Requested characteristic is not supported by service")
-
-        self.peripheral.setDelegate(_DieselHeaterDelegate(self))
+        self._open(timeout_sec, retry_delay)
 
     def _send_command(self, command: int, argument: int, n: int):
-        o = bytearray([0xAA, n % 256, 0, 0, 0, 0, 0, 0])
         if 136 == n:
-            o[2] = random.randint(0, 255)
-            o[3] = random.randint(0, 255)
+            key_hi = random.randint(0, 255)
+            key_lo = random.randint(0, 255)
         else:  # 85
-            o[2] = math.floor(self.passkey / 100)
-            o[3] = self.passkey % 100
-        o[4] = command % 256
-        o[5] = argument % 256
-        o[6] = math.floor(argument / 256)
-        o[7] = o[2] + o[3] + o[4] + o[5] + o[6]
+            key_hi = self._passkey_hi
+            key_lo = self._passkey_lo
+        command &= 0xFF
+        arg_lo = argument & 0xFF
+        arg_hi = (argument >> 8) & 0xFF
+        checksum = (key_hi + key_lo + command + arg_lo + arg_hi) & 0xFF
+        o = self._cmd_buf
+        self._cmd_frame.pack_into(o, 0, 0xAA, n & 0xFF, key_hi, key_lo, command, arg_lo, arg_hi, checksum)
         # print("> " + o.hex(' ', 1))
-        self._last_notification = None
-        try:
-            response = self.characteristic.write(
-                o, withResponse=True
-            )  # returns sth like "{'rsp': ['wr']}"
-        except BTLEDisconnectError as e:
-            logging.getLogger(__name__).debug(f"BLE disconnected during write: {e}")
-            raise BTLEDisconnectError(f"BLE disconnected during write: {e}")
-        except Exception as e:
-            logging.getLogger(__name__).debug(f"Error writing to characteristic: {e}")
-            raise RuntimeError(f"Error writing to characteristic: {e}")
-
-        # Wait for notification with timeout
-        try:
-            wait_result = self.peripheral.waitForNotifications(1.0)
-            if wait_result and self._last_notification:
+        # A missing notification is usually a single lost packet - send the command once more
+        # before reporting no response. A disconnect is not retried: the link is gone.
+        for attempt in range(1, self._command_attempts + 1):
+            self._last_notification = None
+            try:
+                response = self._write(
+                    o, withResponse=True
+                )  # returns sth like "{'rsp': ['wr']}"
+            except BTLEDisconnectError as e:
+                _log.debug("BLE disconnected during write: %s", e)
+                raise BTLEDisconnectError(f"BLE disconnected during write: {e}")
+            except Exception as e:
+                _log.debug("Error writing to characteristic: %s", e)
+                raise RuntimeError(f"Error writing to characteristic: {e}")
+
+            # bluepy hands notifications to the delegate while the write waits for its response,
+            # so the answer may already be here
+            if self._last_notification:
                 return self._last_notification
-            else:
+
+            # Wait for notification with timeout
+            try:
+                wait_result = self._wait(1.0)
+                if wait_result and self._last_notification:
+                    return self._last_notification
                 # No notification received within timeout
-                logging.getLogger(__name__).debug(f"No notification received for command {command} (timeout)")
-                return None
-        except BTLEDisconnectError as e:
-            logging.getLogger(__name__).debug(f"BLE disconnected during waitForNotifications: {e}")
-            raise BTLEDisconnectError(f"BLE disconnected during command: {e}")
-        except Exception as e:
-            logging.getLogger(__name__).debug(f"Error waiting for notification: {e}")
-            raise RuntimeError(f"Error waiting for notification: {e}")
+                _log.debug("No notification received for command %s (timeout, attempt %s/%s)", command, attempt, self._command_attempts)
+            except BTLEDisconnectError as e:
+                _log.debug("BLE disconnected during waitForNotifications: %s", e)
+                raise BTLEDisconnectError(f"BLE disconnected during command: {e}")
+            except Exception as e:
+                _log.debug("Error waiting for notification: %s", e)
+                raise RuntimeError(f"Error waiting for notification: {e}")
+        return None
 
     def get_status(self):
         # todo: mode 136